@@ -1,8 +1,9 @@
 from transformers import AutoModelForMaskedLM, AutoTokenizer
+import functools
+import numpy as np
 import torch
-from tqdm import tqdm
 import inspect
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import antibody_design.utils.id_cdrloop as id_cdrloop
 import pandas as pd
 from safetensors import safe_open
@@ -18,123 +19,252 @@ class Generate:
     model_id: str = "Bo1015/proteinglm-1b-mlm"
     model_weights: str | None = None
     device: object = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    verify_weights: bool = False
+    verify_mask_spans: bool = False
+    compile_model: bool = True
+    seq_len_bucket: int = 32
+    attn_implementation: str = "sdpa"
+    model: object = field(default=None, repr=False)
+    tokenizer: object = field(default=None, repr=False)
     
     @staticmethod
     # Example: Load weights from a .safetensors file
-    def load_weights_safetensors(model, safetensors_path, device="cpu"):
-        """Loads weights from a .safetensors file into a PyTorch model."""
+    def load_weights_safetensors(model, safetensors_path, device="cpu", dtype=torch.bfloat16):
+        """Loads weights from a .safetensors file into a PyTorch model.
+
+        Tensors are memory-mapped and materialized directly on `device`, and
+        assigned in place of the existing parameters rather than copied.
+        Floating-point tensors are cast to `dtype` so an FP32 checkpoint does
+        not silently change the model's precision.
+        """
         loaded_state_dict = {}
-        with safe_open(safetensors_path, framework="pt", device=device) as f:
+        with safe_open(safetensors_path, framework="pt", device=str(device)) as f:
             for key in f.keys():
-                loaded_state_dict[key] = f.get_tensor(key)
+                tensor = f.get_tensor(key)
+                if tensor.is_floating_point():
+                    tensor = tensor.to(dtype, copy=False)
+                loaded_state_dict[key] = tensor
         
-        model.load_state_dict(loaded_state_dict)
+        model.load_state_dict(loaded_state_dict, assign=True)
         return model
 
+    @staticmethod
+    def weights_checksum(model):
+        """Single-reduction fingerprint of all model parameters (one device sync)."""
+        return torch.stack([p.detach().float().sum() for p in model.parameters()]).sum().item()
+
     def __post_init__(self):
         
-        # Load model and tokenizer
-        self.tokenizer  = AutoTokenizer.from_pretrained(self.model_id, trust_remote_code=True, use_fast=True)
-        self.model = AutoModelForMaskedLM.from_pretrained(self.model_id, trust_remote_code=True, torch_dtype=torch.bfloat16).cuda()
-
-        if self.model_weights == None:
-            initial_state_dict = self.model.state_dict()
-            for it_k, key in enumerate(initial_state_dict):
-                if it_k %1 == 0: 
-                    print(initial_state_dict[key])
-
-        elif self.model_weights !=None:
-            # 1. Save the initial state
-            initial_state_dict = self.model.state_dict()
-            self.model = self.load_weights_safetensors(self.model, self.model_weights)#.load_state_dict(self.model_weights)#state_dict)
-            if torch.cuda.is_available():
-                self.model = self.model.cuda()
-            self.model.eval()
-            # 3. Compare the states
-            updated_state_dict = self.model.state_dict()
-
-            modified_weights = {}
-            
-            for it_k, key in enumerate(initial_state_dict):
-                if it_k %1 == 0: 
-                    print(initial_state_dict[key])
-                    print(updated_state_dict[key])
-                if not torch.equal(initial_state_dict[key], updated_state_dict[key]):
-                    modified_weights[key] = "Modified"
-                else:
-                     modified_weights[key] = "Not Modified"
-            # 4. Print or process the modified weights
-            for key, status in modified_weights.items():
-                if status == 'Modified':
-                    print(f"Layer: {key}, Status: {status}")
+        # Load model and tokenizer, unless already-loaded ones were passed in
+        # (e.g. shared across refinement rounds)
+        if self.tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_id, trust_remote_code=True, use_fast=True)
+        if self.model is None:
+            self.model = self.load_model()
 
-    def mask_inp_ab(self):
+        # Inputs are padded to a small set of bucketed lengths in tokenize_seq,
+        # so the compiled graph is reused instead of recompiled per sequence
+        self._warm_shapes = set()
+        self._tokenize = functools.lru_cache(maxsize=32)(self._tokenize_cpu)
+
+    def load_model(self):
+        """Load the MLM (plus optional custom weights), frozen in eval mode and optionally compiled."""
+        try:
+            model = AutoModelForMaskedLM.from_pretrained(self.model_id, trust_remote_code=True, torch_dtype=torch.bfloat16,
+                                                         attn_implementation=self.attn_implementation).to(self.device)
+        except (ValueError, ImportError) as e:
+            # Remote-code architectures that don't declare SDPA/flash support reject the flag
+            print(f"Warning: attn_implementation={self.attn_implementation!r} not supported ({e}); using model default")
+            model = AutoModelForMaskedLM.from_pretrained(self.model_id, trust_remote_code=True, torch_dtype=torch.bfloat16).to(self.device)
+
+        if self.model_weights is not None:
+            if self.verify_weights:
+                initial_checksum = self.weights_checksum(model)
+            model = self.load_weights_safetensors(model, self.model_weights, device=self.device)
+            if self.verify_weights:
+                updated_checksum = self.weights_checksum(model)
+                status = "Modified" if updated_checksum != initial_checksum else "Not Modified"
+                print(f"Weights checksum: {initial_checksum} -> {updated_checksum} ({status})")
+            assert next(model.parameters()).dtype == torch.bfloat16, "custom weights must load as bfloat16"
+
+        model.eval()
+        model.requires_grad_(False)
+
+        if self.compile_model:
+            model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        return model
+
+    def warmup(self, shape):
+        """Run dummy forwards so compilation for a (batch, seq_len) `shape` happens before real inputs."""
+        if not self.compile_model or shape in self._warm_shapes:
+            return
+        input_ids = torch.full(shape, self.tokenizer.mask_token_id, device=self.device)
+        attention_mask = torch.ones_like(input_ids)
+        with torch.inference_mode():
+            for _ in range(2):
+                self.model(input_ids=input_ids, attention_mask=attention_mask)
+        self._warm_shapes.add(shape)
+
+    def _build_mask_spans(self):
+        """Locate every CDR to mask once; returns an int32 array of (chain_id, start, end) rows, end exclusive."""
+        chain_seqs = (self.H_seq, self.L_seq)
+        rows = []
         for cdrid in self.cdrs_mut:
-            cdrseq = self.cdrdict[cdrid] 
             if cdrid in self.cdrs_heavy:
-                cdrseq_st = self.H_seq.find(cdrseq)
-                cdrseq_end = cdrseq_st + len(cdrseq) - 1
-                self.H_seq = self.H_seq[:cdrseq_st] +\
-                                     '<mask>' * (len(cdrseq)) +\
-                                          self.H_seq[cdrseq_end:] 
+                chain_id = 0
             elif cdrid in self.cdrs_light:
-                cdrseq_st = self.L_seq.find(cdrseq)
-                cdrseq_end = cdrseq_st + len(cdrseq)# - 1
-                self.L_seq = self.L_seq[:cdrseq_st] +\
-                                     '<mask>' * (len(cdrseq)) +\
-                                          self.L_seq[cdrseq_end:]
+                chain_id = 1
+            else:
+                continue
+            cdrseq = self.cdrdict[cdrid] 
+            cdrseq_st = chain_seqs[chain_id].find(cdrseq)
+            if cdrseq_st != -1:
+                rows.append((chain_id, cdrseq_st, cdrseq_st + len(cdrseq)))
+        return np.array(rows, dtype=np.int32).reshape(-1, 3)
+
+    def mask_inp_ab(self):
+        # Apply all CDR spans to per-residue buffers, one pass per chain,
+        # and join each chain once
+        self._mask_spans = self._build_mask_spans()
+        chain_bufs = []
+        for chain_id, seq in enumerate((self.H_seq, self.L_seq)):
+            buf = list(seq)
+            for _, start, end in self._mask_spans[self._mask_spans[:, 0] == chain_id]:
+                buf[start:end] = ['<mask>'] * (end - start)
+            chain_bufs.append(buf)
+
+        # Character spans of the <mask> runs, so tokenize_seq can locate mask
+        # tokens without scanning input_ids on the device
+        self.mask_spans = {chain: self._mask_char_spans(buf) for chain, buf in zip(['heavy', 'light'], chain_bufs)}
+        self.H_seq = "".join(chain_bufs[0])
+        self.L_seq = "".join(chain_bufs[1])
+
+    @staticmethod
+    def _mask_char_spans(buf):
+        """(start, end) character spans of consecutive <mask> entries in a residue buffer."""
+        spans = []
+        char_pos = 0
+        for res in buf:
+            if res == '<mask>':
+                if spans and spans[-1][1] == char_pos:
+                    spans[-1] = (spans[-1][0], char_pos + len(res))
+                else:
+                    spans.append((char_pos, char_pos + len(res)))
+            char_pos += len(res)
+        return spans
 
     def tokenize_seq(self,
-                     seq): 
-        inputs = self.tokenizer(seq, return_tensors='pt')
-        input_ids = inputs['input_ids'].to(self.device)
-        attention_mask = inputs['attention_mask'].to(self.device)
+                     seq,
+                     mask_spans=None): 
+        """Tokenize one sequence or a list of sequences into a padded batch.
 
-        # Identify mask token positions
-        mask_token_id = self.tokenizer.mask_token_id
-        mask_indices = (input_ids == mask_token_id).nonzero(as_tuple=False)  # shape: (num_masks, 2)
+        `mask_spans` holds, per sequence, the (start, end) character spans of
+        its <mask> runs; mask token positions are then resolved on the CPU from
+        the offset mapping and moved to the device in a single transfer.
+        Tokenizer output is cached per (sequences, spans), so repeated calls on
+        the same inputs only pay for the host-to-device copy.
+        """
+        seqs = (seq,) if isinstance(seq, str) else tuple(seq)
+        spans = None if mask_spans is None else tuple(tuple(row_spans) for row_spans in mask_spans)
+        input_ids, attention_mask, mask_indices = self._tokenize(seqs, spans)
+
+        input_ids = input_ids.to(self.device, non_blocking=True)
+        attention_mask = attention_mask.to(self.device, non_blocking=True)
+        mask_indices = mask_indices.to(self.device, non_blocking=True)
+        self.warmup(tuple(input_ids.shape))
 
         return input_ids, attention_mask, mask_indices
 
+    def _tokenize_cpu(self, seqs, mask_spans):
+        """Tokenize on the CPU; returns (input_ids, attention_mask, mask_indices), pinned when targeting CUDA."""
+        use_offsets = mask_spans is not None and self.tokenizer.is_fast
+        inputs = self.tokenizer(list(seqs), return_tensors='pt', padding=True, pad_to_multiple_of=self.seq_len_bucket,
+                                return_offsets_mapping=use_offsets)
+
+        # Identify mask token positions, shape: (num_masks, 2) as (batch_idx, pos)
+        if use_offsets:
+            mask_indices = self.span_token_indices(inputs.pop('offset_mapping'), mask_spans)
+            if self.verify_mask_spans:
+                # Spans must resolve to exactly the <mask> tokens of every row
+                expected = (inputs['input_ids'] == self.tokenizer.mask_token_id).nonzero(as_tuple=False)
+                assert torch.equal(mask_indices, expected), "mask spans do not match <mask> token positions"
+        else:
+            mask_indices = (inputs['input_ids'] == self.tokenizer.mask_token_id).nonzero(as_tuple=False)
+
+        tensors = (inputs['input_ids'], inputs['attention_mask'], mask_indices)
+        if torch.device(self.device).type == "cuda":
+            tensors = tuple(t.pin_memory() for t in tensors)
+        return tensors
+
+    @staticmethod
+    def span_token_indices(offsets, mask_spans):
+        """Map per-row character spans to (batch_idx, pos) token indices using the offset mapping."""
+        starts, ends = offsets[..., 0], offsets[..., 1]
+        is_masked = torch.zeros(starts.shape, dtype=torch.bool)
+        for row, spans in enumerate(mask_spans):
+            # Only this row's offsets: (L,) against the row's own spans
+            row_starts, row_ends = starts[row], ends[row]
+            for span_st, span_end in spans:
+                is_masked[row] |= (row_starts >= span_st) & (row_ends <= span_end) & (row_ends > row_starts)
+        return is_masked.nonzero(as_tuple=False)
+
+    @torch.inference_mode()
     def generate(self,
                  input_ids, 
                  attention_mask, 
                  mask_indices
                  ):
-        generated_sequences = []
+        """Sample n_seq_out sequences for every row of the batch; returns one deduplicated list per row."""
+        # Model output is deterministic for a fixed masked input, so one
+        # forward pass is enough; draw all n_seq_out samples from it at once
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
+        logits = outputs.logits  # shape: (batch, seq_len, vocab_size)
 
-        # Generate n_seq_out sequences
-        with torch.inference_mode():
-            for _ in tqdm(range(self.n_seq_out)):
-                outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
-                logits = outputs.logits[0]  # shape: (seq_len, vocab_size)
-
-                sampled_ids = input_ids.clone()
-
-                for idx in mask_indices:
-                    pos = idx[1]
-                    # Sample from distribution at masked position
-                    probs = torch.softmax(logits[pos], dim=-1)
-                    sampled_token_id = torch.multinomial(probs, num_samples=1)
-                    sampled_ids[0, pos] = sampled_token_id
-
-                # Decode the sampled sequence
-                decoded_seq = self.tokenizer.decode(sampled_ids[0], skip_special_tokens=True)
-                seq_out = "".join(decoded_seq.split())
-                generated_sequences.append(seq_out)
+        rows, positions = mask_indices[:, 0], mask_indices[:, 1]
+        mask_logits = logits[rows, positions].float()  # shape: (num_masks, vocab_size)
+
+        # Gumbel-max trick: argmax(logits + Gumbel(0, 1)) is a sample from
+        # softmax(logits), without the softmax or a multinomial device sync
+        mask_logits = mask_logits.expand(self.n_seq_out, -1, -1)  # shape: (n_seq_out, num_masks, vocab_size)
+        # -log(Exp(1)) ~ Gumbel(0, 1): one log instead of two and no epsilon clamps
+        gumbel = -torch.empty_like(mask_logits).exponential_().log()
+        samples = torch.argmax(mask_logits + gumbel, dim=-1)  # shape: (n_seq_out, num_masks)
+
+        sampled_ids = input_ids.repeat(self.n_seq_out, 1, 1)  # shape: (n_seq_out, batch, seq_len)
+        sampled_ids[:, rows, positions] = samples
+
+        # Decode every sample of every row in one call, then keep the first
+        # occurrence of each distinct sequence per row in sampling order
+        batch_size, seq_len = input_ids.shape
+        decoded_seqs = self.tokenizer.batch_decode(
+            sampled_ids.transpose(0, 1).reshape(-1, seq_len),
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        )
+        decoded_seqs = [decoded_seq.replace(" ", "") for decoded_seq in decoded_seqs]
+        generated_sequences = []
+        for row in range(batch_size):
+            row_seqs = decoded_seqs[row * self.n_seq_out:(row + 1) * self.n_seq_out]
+            generated_sequences.append(list(dict.fromkeys(row_seqs)))
         return generated_sequences
 
+    @torch.inference_mode()
     def run_generate(self):
         generated_dict = {'heavy': None, 'light': None}
         self.mask_inp_ab()
-        
-        for (seqid,seq) in zip(['heavy', 'light'], [self.H_seq, self.L_seq]):
-            input_ids, attention_mask, mask_indices = self.tokenize_seq(seq)
-            generated_dict[seqid] = list(set(self.generate(
-                                        input_ids, 
-                                        attention_mask, 
-                                        mask_indices
-                                        )))
+
+        # Heavy and light chains are independent, so pad and run them as one batch
+        input_ids, attention_mask, mask_indices = self.tokenize_seq(
+                        [self.H_seq, self.L_seq],
+                        [self.mask_spans['heavy'], self.mask_spans['light']]
+                        )
+        generated = self.generate(
+                        input_ids, 
+                        attention_mask, 
+                        mask_indices
+                        )
+        for seqid, seqs in zip(['heavy', 'light'], generated):
+            generated_dict[seqid] = seqs
         return generated_dict
 
 if __name__ == "__main__":
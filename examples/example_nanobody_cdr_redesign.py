@@ -160,18 +160,20 @@ print("=" * 80)
 current_seq = mutator_inspect.get_peptide_sequence()
 print(f"\nStarting sequence: {current_seq}")
 
+# Create the mutator once and reuse its loaded model across rounds
+mutator_iter = UncertaintyGuidedMutation(
+    target_seq=target_seq,
+    temp_pept_seq=current_seq,
+    modality="nanobody",
+    nanobody_cdr_regions=["CDR3"],
+    mask_ratio=0.3,
+    n_seq_out=3,
+)
+
 for iteration in range(2):
     print(f"\n--- Iteration {iteration + 1} ---")
     
-    mutator_iter = UncertaintyGuidedMutation(
-        target_seq=target_seq,
-        temp_pept_seq=current_seq,
-        modality="nanobody",
-        nanobody_cdr_regions=["CDR3"],
-        mask_ratio=0.3,
-        n_seq_out=3,
-    )
-    
+    mutator_iter.set_sequence(current_seq)
     results_iter = mutator_iter.run()
     
     # Select best variant (in practice, validate with binding assay)
@@ -2,22 +2,45 @@
 Test script for uncertainty-guided mutation generation with modality support.
 """
 
+from dataclasses import fields
+
 import torch
 from uncertainty_guided_mutation import UncertaintyGuidedMutation, MODALITY_TEMPLATES
 
+TARGET_SEQ = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
+TEMP_PEPT_SEQ = "HELVELLA"
+
+# Settings the tests vary; configure() resets them to their dataclass defaults
+CONFIG_FIELDS = (
+    "modality", "n_seq_out", "mask_strategy", "mask_ratio", "uncertainty_threshold",
+    "use_template", "custom_template", "residues_to_mutate",
+)
+DEFAULT_CONFIG = {
+    f.name: f.default for f in fields(UncertaintyGuidedMutation) if f.name in CONFIG_FIELDS
+}
+
+
+def configure(mutator, **settings):
+    """
+    Reconfigure the shared mutator in place for one test.
+
+    Only plain fields are assigned, so the loaded model, tokenizer, warmed
+    shapes and compiled engines are kept (no __post_init__ re-run).
+    """
+    mutator.temp_pept_seq = TEMP_PEPT_SEQ
+    for name, value in {**DEFAULT_CONFIG, **settings}.items():
+        setattr(mutator, name, value)
+    return mutator
+
 
-def test_basic_workflow():
+def test_basic_workflow(base_mutator):
     """Test the basic workflow with a simple example."""
     print("=" * 80)
     print("TEST 1: Basic Workflow")
     print("=" * 80)
     
-    target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
-    temp_pept_seq = "HELVELLA"
-    
-    mutator = UncertaintyGuidedMutation(
-        target_seq=target_seq,
-        temp_pept_seq=temp_pept_seq,
+    mutator = configure(
+        base_mutator,
         mask_strategy="top_k",
         mask_ratio=0.3,
         n_seq_out=3,
@@ -32,27 +55,24 @@ def test_basic_workflow():
     return results
 
 
-def test_different_mask_strategies():
+def test_different_mask_strategies(base_mutator):
     """Test different masking strategies."""
     print("\n" + "=" * 80)
     print("TEST 2: Different Masking Strategies")
     print("=" * 80)
     
-    target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
-    temp_pept_seq = "HELVELLA"
-    
     strategies = [
         ("top_k", {"mask_ratio": 0.3}),
         ("top_k", {"mask_ratio": 0.5}),
         ("threshold", {"uncertainty_threshold": 0.4}),
+        ("entropy", {"mask_ratio": 0.3}),
     ]
     
     for strategy, kwargs in strategies:
         print(f"\n--- Strategy: {strategy} with {kwargs} ---")
         
-        mutator = UncertaintyGuidedMutation(
-            target_seq=target_seq,
-            temp_pept_seq=temp_pept_seq,
+        mutator = configure(
+            base_mutator,
             mask_strategy=strategy,
             n_seq_out=2,
             **kwargs
@@ -63,29 +83,22 @@ def test_different_mask_strategies():
         print(f"Generated: {results['generated_sequences'][0]}")
 
 
-def test_uncertainty_analysis():
-    """Analyze uncertainty distribution."""
+def test_uncertainty_analysis(results):
+    """Analyze uncertainty distribution of an earlier run() (no extra forward pass)."""
     print("\n" + "=" * 80)
     print("TEST 3: Uncertainty Analysis (Peptide Only)")
     print("=" * 80)
 
-    target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
-    temp_pept_seq = "HELVELLA"
-
-    mutator = UncertaintyGuidedMutation(
-        target_seq=target_seq,
-        temp_pept_seq=temp_pept_seq,
-    )
-
-    input_seq = f"{target_seq}<eos>{temp_pept_seq}"
-    _, probs, mask_indices = mutator.get_logprobs(input_seq)
-    uncertainty = mutator.compute_uncertainty(probs)
+    # Uncertainty depends only on the input sequence, not on the masking or
+    # sampling settings, so the basic workflow's run() results can be reused
+    uncertainty = results["uncertainty"]
+    mask_indices = results["mask_indices"]
 
     # Find peptide start index
-    peptide_start_idx = mutator.find_peptide_start_idx(input_seq)
-    peptide_mask_indices = [idx for idx in mask_indices if idx >= peptide_start_idx]
+    peptide_start_idx = results["peptide_start_idx"]
+    peptide_mask_indices = mask_indices[mask_indices >= peptide_start_idx]
 
-    print(f"\nPeptide token indices: {peptide_mask_indices}")
+    print(f"\nPeptide token indices: {peptide_mask_indices.tolist()}")
     print(f"\nUncertainty statistics (peptide only):")
     print(f"  Mean: {uncertainty[peptide_mask_indices].mean():.4f}")
     print(f"  Std:  {uncertainty[peptide_mask_indices].std():.4f}")
@@ -100,23 +113,21 @@ def test_uncertainty_analysis():
 
     print(f"\nTop {len(top_uncertain_indices)} most uncertain positions (peptide):")
     for rank, idx in enumerate(top_uncertain_indices, 1):
-        pos = peptide_mask_indices[idx]
+        pos = int(peptide_mask_indices[idx])
         print(f"  {rank}. Position {pos}: uncertainty={uncertainty[pos]:.4f}")
 
 
-def test_modality_templates():
+def test_modality_templates(base_mutator):
     """Test different modality templates."""
     print("\n" + "=" * 80)
     print("TEST 4: Modality Templates")
     print("=" * 80)
 
-    target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
-
     for modality in ["affibody", "nanobody", "affitin"]:
         print(f"\n--- Modality: {modality} ---")
 
-        mutator = UncertaintyGuidedMutation(
-            target_seq=target_seq,
+        mutator = configure(
+            base_mutator,
             temp_pept_seq="",
             modality=modality,
             use_template=True,
@@ -130,24 +141,21 @@ def test_modality_templates():
         print(f"Generated: {results['generated_sequences'][0][:50]}...")
 
 
-def test_specific_residues():
+def test_specific_residues(base_mutator):
     """Test mutation of specific residues."""
     print("\n" + "=" * 80)
     print("TEST 5: Specific Residue Mutation")
     print("=" * 80)
 
-    target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
-    temp_pept_seq = "HELVELLA"
-
+    temp_pept_seq = TEMP_PEPT_SEQ
     residues_to_mutate = [0, 2, 4, 6]
 
     print(f"\nPeptide: {temp_pept_seq}")
     print(f"Residues to mutate (0-indexed): {residues_to_mutate}")
     print(f"Positions: {[temp_pept_seq[i] for i in residues_to_mutate]}")
 
-    mutator = UncertaintyGuidedMutation(
-        target_seq=target_seq,
-        temp_pept_seq=temp_pept_seq,
+    mutator = configure(
+        base_mutator,
         residues_to_mutate=residues_to_mutate,
         n_seq_out=3,
     )
@@ -159,19 +167,18 @@ def test_specific_residues():
         print(f"  {i}. {seq}")
 
 
-def test_custom_template():
+def test_custom_template(base_mutator):
     """Test custom template override."""
     print("\n" + "=" * 80)
     print("TEST 6: Custom Template Override")
     print("=" * 80)
 
-    target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"
     custom_template = "MYOWNSEQUENCE"
 
     print(f"\nCustom template: {custom_template}")
 
-    mutator = UncertaintyGuidedMutation(
-        target_seq=target_seq,
+    mutator = configure(
+        base_mutator,
         temp_pept_seq="",
         modality="affibody",
         use_template=True,
@@ -185,14 +192,41 @@ def test_custom_template():
     print(f"Template matches custom: {results['peptide_seq'] == custom_template}")
 
 
+def test_run_batch_matches_run(base_mutator):
+    """Test that run_batch() masks the same positions as run() for one peptide."""
+    print("\n" + "=" * 80)
+    print("TEST 7: Batched Run Matches run()")
+    print("=" * 80)
+
+    for strategy in ["top_k", "entropy", "threshold"]:
+        mutator = configure(base_mutator, mask_strategy=strategy, n_seq_out=2)
+
+        single = mutator.run()
+        batched = mutator.run_batch([TEMP_PEPT_SEQ])[0]
+        # run() lists top-k positions by score; run_batch() lists them in sequence order
+        match = sorted(single["positions_to_mask"]) == batched["positions_to_mask"]
+
+        print(f"\n--- Strategy: {strategy} ---")
+        print(f"run():       {single['positions_to_mask']}")
+        print(f"run_batch(): {batched['positions_to_mask']}")
+        print(f"Positions match: {match}")
+        assert match, f"run_batch() masked different positions than run() ({strategy})"
+
+
 if __name__ == "__main__":
     try:
-        test_basic_workflow()
-        test_different_mask_strategies()
-        test_uncertainty_analysis()
-        test_modality_templates()
-        test_specific_residues()
-        test_custom_template()
+        # Load the model once; every test reuses it
+        base_mutator = UncertaintyGuidedMutation(
+            target_seq=TARGET_SEQ,
+            temp_pept_seq=TEMP_PEPT_SEQ,
+        )
+        basic_results = test_basic_workflow(base_mutator)
+        test_different_mask_strategies(base_mutator)
+        test_uncertainty_analysis(basic_results)
+        test_modality_templates(base_mutator)
+        test_specific_residues(base_mutator)
+        test_custom_template(base_mutator)
+        test_run_batch_matches_run(base_mutator)
         print("\n" + "=" * 80)
         print("All tests completed!")
         print("=" * 80)
@@ -12,6 +12,7 @@ Includes CDR loop identification for nanobody redesign.
 """
 
 from transformers import AutoModelForMaskedLM, AutoTokenizer
+from transformers.modeling_outputs import MaskedLMOutput
 import torch
 try:
     import intel_extension_for_pytorch
@@ -19,9 +20,10 @@ try:
 except Exception as e:
     print(e)
     INTEL_AVAILABLE=False
-from dataclasses import dataclass
+import os
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from typing import Tuple, List, Dict
-from tqdm import tqdm
 
 try:
     from abnumber import Chain
@@ -29,6 +31,41 @@ try:
 except ImportError:
     HAS_ABNUMBER = False
 
+try:
+    import bitsandbytes  # noqa: F401  (int8 weights for load_in_8bit)
+    HAS_BITSANDBYTES = True
+except ImportError:
+    HAS_BITSANDBYTES = False
+
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+    # Prefer fused flash / memory-efficient attention; keep math as a last resort
+    SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+    HAS_SDPA_KERNEL = True
+except ImportError:
+    HAS_SDPA_KERNEL = False
+
+# Ahead-of-time compile backends accepted by compile_backend (None = eager / torch.compile)
+COMPILE_BACKENDS = (None, "tensorrt", "onnxruntime")
+
+
+
+class _LogitsForward(torch.nn.Module):
+    """
+    (input_ids, attention_mask) -> logits wrapper for ahead-of-time compilation.
+
+    AOT compilers bind inputs positionally; remote-code forwards may take
+    something else (e.g. position_ids) second, so the model is called by keyword.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+
 # Template sequences for different modalities
 MODALITY_TEMPLATES = {
     "affibody": "VDNKFNKELSVAGREIVTLPNLNDPQKKAFIFSLWDDPSQSANLLAEAKKLNDAQAPK",
@@ -44,6 +81,11 @@ NANOBODY_CDR_REGIONS_IMGT = {
     "CDR3": (94, 102),
 }
 
+# Precomputed residue indices for each fallback CDR region
+NANOBODY_CDR_IDX_TENSOR = {
+    name: torch.arange(start, end + 1) for name, (start, end) in NANOBODY_CDR_REGIONS_IMGT.items()
+}
+
 
 @dataclass
 class UncertaintyGuidedMutation:
@@ -59,13 +101,28 @@ class UncertaintyGuidedMutation:
         device: Device to run model on (auto-detected)
         n_seq_out: Number of sequences to generate
         mask_strategy: How to select positions to mask ("top_k", "threshold", "entropy")
-        mask_ratio: For top_k strategy, fraction of peptide positions to mask
+        mask_ratio: For top_k and entropy strategies, fraction of peptide positions to mask
         uncertainty_threshold: For threshold strategy, uncertainty cutoff
         use_template: Whether to use template sequence for the modality
         custom_template: Custom template sequence (overrides modality template)
         residues_to_mutate: Optional list of residue indices to mutate (0-indexed in peptide)
         nanobody_cdr_regions: For nanobody: which CDRs to mutate (list of "CDR1", "CDR2", "CDR3")
             Uses abnumber library with IMGT numbering for accurate identification
+        compile_model: Whether to wrap the model with torch.compile for repeated-shape inference
+        compile_backend: Optional ahead-of-time backend ("tensorrt" or "onnxruntime"),
+            built lazily on first use; replaces torch.compile when set
+        onnx_path: Where the "onnxruntime" backend exports (or, if present, loads) the
+            ONNX model; required for that backend
+        attn_implementation: Attention kernel requested from transformers ("sdpa",
+            "flash_attention_2", "eager"); falls back to the model default if unsupported
+        load_in_8bit: Load the model with int8 weights via bitsandbytes (CUDA only;
+            cannot be combined with model_weights)
+        seq_len_bucket: Pad token length up to a multiple of this so compiled graphs
+            are reused across nearby input lengths (0 or None disables padding; only
+            applied with compile_model or compile_backend)
+        verbose: Print intermediate pipeline results from run()
+        model: Optional already-loaded model to reuse (skips loading and model_weights)
+        tokenizer: Optional already-loaded tokenizer to reuse
     """
     target_seq: str
     temp_pept_seq: str = ""  # Optional if use_template=True
@@ -75,12 +132,21 @@ class UncertaintyGuidedMutation:
     device: object = torch.device("cuda" if torch.cuda.is_available() else "xpu" if INTEL_AVAILABLE else "cpu")
     n_seq_out: int = 10
     mask_strategy: str = "top_k"  # "top_k", "threshold", or "entropy"
-    mask_ratio: float = 0.3  # For top_k: fraction of positions to mask
+    mask_ratio: float = 0.3  # For top_k / entropy: fraction of positions to mask
     uncertainty_threshold: float = 0.5  # For threshold strategy
     use_template: bool = False  # Whether to use template for modality
     custom_template: str | None = None  # Custom template sequence
     residues_to_mutate: List[int] | None = None  # Specific residue indices to mutate
     nanobody_cdr_regions: List[str] | None = None  # For nanobody: ["CDR1", "CDR2", "CDR3"]
+    compile_model: bool = True  # torch.compile the model forward
+    compile_backend: str | None = None  # Opt-in AOT backend: "tensorrt" or "onnxruntime"
+    onnx_path: str | None = None  # Exported ONNX model for the "onnxruntime" backend
+    attn_implementation: str = "sdpa"  # "sdpa", "flash_attention_2", or "eager"
+    load_in_8bit: bool = False  # int8 weights via bitsandbytes
+    seq_len_bucket: int | None = 32  # Pad token length to a multiple of this
+    verbose: bool = False  # Print intermediate results in run()
+    model: object = field(default=None, repr=False)  # Reuse a loaded model
+    tokenizer: object = field(default=None, repr=False)  # Reuse a loaded tokenizer
     
     def __post_init__(self):
         """Load model and tokenizer, validate inputs."""
@@ -91,18 +157,331 @@ class UncertaintyGuidedMutation:
                 "Cannot proceed without a peptide sequence."
             )
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_id, trust_remote_code=True, use_fast=True
+        if self.compile_backend not in COMPILE_BACKENDS:
+            raise ValueError(
+                f"Unknown compile_backend: {self.compile_backend}. Choose from {COMPILE_BACKENDS}"
+            )
+        if self.compile_backend == "onnxruntime" and self.onnx_path is None:
+            raise ValueError("compile_backend='onnxruntime' requires onnx_path for the exported model")
+
+        if self.load_in_8bit and self.model is None:
+            if not HAS_BITSANDBYTES:
+                raise ImportError("load_in_8bit requires bitsandbytes: pip install bitsandbytes")
+            if self.model_weights is not None:
+                raise ValueError("model_weights cannot be loaded into an int8 model; set load_in_8bit=False")
+            if self.compile_backend == "onnxruntime":
+                raise ValueError("The onnxruntime backend exports by casting the model; set load_in_8bit=False")
+
+        if self.tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                self.model_id, trust_remote_code=True, use_fast=True
+            )
+
+        # Trimming to the unpadded length (run, run_batch) assumes padding on the right;
+        # some remote-code tokenizers default to left padding
+        self.tokenizer.padding_side = "right"
+
+        # Cache special token ids instead of going through the tokenizer on every call
+        self.mask_token_id = self.tokenizer.mask_token_id
+        self.eos_token_id = self.tokenizer.eos_token_id
+        # Special ids (<eos>, padding, ...) are never uncertainty candidates and are
+        # dropped when decoding: a host set for decoding, a device copy for torch.isin
+        self.special_ids = set(self.tokenizer.all_special_ids)
+        self.special_ids_device = torch.tensor(
+            sorted(self.special_ids), dtype=torch.long, device=self.device
+        )
+        # One residue per token: decode by id lookup instead of tokenizer.decode
+        self.id2tok = self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer))))
+
+        # Pinned host buffers let host-to-device copies run asynchronously
+        self._pin_memory = torch.device(self.device).type == "cuda"
+        if self._pin_memory:
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+
+        # Allow TF32 for any float32 matmuls on Ampere+
+        torch.set_float32_matmul_precision('high')
+
+        # A model passed in is assumed ready to use (weights loaded, eval mode)
+        if self.model is None:
+            load_kwargs = dict(trust_remote_code=True, torch_dtype=torch.bfloat16)
+            if self.load_in_8bit:
+                from transformers import BitsAndBytesConfig
+
+                # Linear layers hold int8 weights; activations stay in bf16
+                load_kwargs.update(
+                    quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                    device_map=str(self.device),
+                )
+
+            try:
+                self.model = AutoModelForMaskedLM.from_pretrained(
+                    self.model_id, attn_implementation=self.attn_implementation, **load_kwargs
+                )
+            except (ValueError, ImportError) as e:
+                # Remote-code architectures that don't declare SDPA/flash support reject the flag
+                print(f"Warning: attn_implementation={self.attn_implementation!r} not supported ({e}); using model default")
+                self.model = AutoModelForMaskedLM.from_pretrained(self.model_id, **load_kwargs)
+
+            if not self.load_in_8bit:
+                self.model = self.model.to(self.device)
+
+            # Load custom weights if provided
+            if self.model_weights is not None:
+                self.model = self._load_weights_safetensors(self.model, self.model_weights)
+
+            self.model.eval()
+
+            if self.compile_model and self.compile_backend is None:
+                self.model = self._compile_model(self.model)
+
+        self._warm_shapes = set()
+        self._static_engines = {}  # (batch, seq_len) -> AOT-compiled forward returning logits
+        self._onnx_session = None  # Shared by all shapes (exported with dynamic axes)
+
+    @staticmethod
+    def _compile_model(model):
+        """
+        Wrap the model with torch.compile (the eager model stays reachable as `_orig_mod`).
+
+        Args:
+            model: The eager model
+
+        Returns:
+            model: Compiled model, or the eager model if compilation is unavailable
+        """
+        try:
+            return torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        except Exception as e:
+            print(f"Warning: torch.compile unavailable ({e}); using eager model")
+            return model
+
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        """
+        Run the model forward, reverting to the eager model if compilation fails.
+
+        Scaled-dot-product attention is restricted to the fused flash and
+        memory-efficient kernels where available, with math as the fallback.
+
+        Args:
+            input_ids: Token ids (batch, seq_len)
+            attention_mask: Attention mask (batch, seq_len)
+
+        Returns:
+            outputs: Model outputs
+        """
+        engine = self._static_engines.get(tuple(input_ids.shape))
+        if engine is not None:
+            try:
+                return MaskedLMOutput(logits=engine(input_ids, attention_mask))
+            except Exception as e:
+                # Disable the backend, as a failed build does, so warmup doesn't rebuild it every run
+                print(f"Warning: {self.compile_backend} engine failed ({e}); falling back to eager model")
+                self.compile_backend = None
+                self._static_engines.clear()
+
+        attention_context = sdpa_kernel(SDPA_BACKENDS) if HAS_SDPA_KERNEL else nullcontext()
+        with attention_context:
+            try:
+                return self.model(input_ids=input_ids, attention_mask=attention_mask)
+            except Exception as e:
+                eager_model = getattr(self.model, "_orig_mod", None)  # set by torch.compile
+                if eager_model is None:
+                    raise
+                print(f"Warning: compiled model failed ({e}); falling back to eager model")
+                self.model = eager_model
+                return self.model(input_ids=input_ids, attention_mask=attention_mask)
+
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Copy a tensor to self.device, through pinned memory and non-blocking on CUDA.
+
+        Args:
+            tensor: Tensor to move
+
+        Returns:
+            tensor: Tensor on self.device
+        """
+        if self._pin_memory and tensor.device.type == "cpu":
+            return tensor.pin_memory().to(self.device, non_blocking=True)
+        return tensor.to(self.device)
+
+    def _tokenize(self, input_seqs) -> Dict[str, torch.Tensor]:
+        """
+        Tokenize, right-padding to a multiple of seq_len_bucket when compiled.
+
+        Bucketed lengths keep the number of distinct input shapes small, so
+        compiled graphs (and warmup) are reused instead of recompiled. The
+        eager model has no graphs to reuse, so it only pads batches to their
+        longest row.
+
+        Args:
+            input_seqs: Input sequence or list of sequences
+
+        Returns:
+            inputs: Tokenizer output (return_tensors='pt'); attention_mask is 0 on padding
+        """
+        return self.tokenizer(
+            input_seqs,
+            return_tensors='pt',
+            padding=True,
+            pad_to_multiple_of=(self.seq_len_bucket or None) if self._static_shapes else None,
         )
-        self.model = AutoModelForMaskedLM.from_pretrained(
-            self.model_id, trust_remote_code=True, torch_dtype=torch.bfloat16
-        ).to(self.device)
 
-        # Load custom weights if provided
-        if self.model_weights is not None:
-            self.model = self._load_weights_safetensors(self.model, self.model_weights)
+    @property
+    def _static_shapes(self) -> bool:
+        """Whether a torch.compile or ahead-of-time path benefits from fixed input shapes."""
+        return self.compile_backend is not None or getattr(self.model, "_orig_mod", None) is not None
+
+    def _build_static_engine(self, shape: Tuple[int, int]):
+        """
+        Compile the model ahead of time for one static input shape.
+
+        Args:
+            shape: (batch, seq_len) of the inputs the engine will accept
+
+        Returns:
+            engine: Callable (input_ids, attention_mask) -> logits
+        """
+        eager_model = getattr(self.model, "_orig_mod", self.model)
+
+        if self.compile_backend == "tensorrt":
+            import torch_tensorrt
+
+            return torch_tensorrt.compile(
+                _LogitsForward(eager_model),
+                inputs=[
+                    torch_tensorrt.Input(shape=shape, dtype=torch.int64),  # input_ids
+                    torch_tensorrt.Input(shape=shape, dtype=torch.int64),  # attention_mask
+                ],
+                enabled_precisions={torch.bfloat16},
+            )
+
+        if self.compile_backend == "onnxruntime":
+            if self._onnx_session is None:
+                self._onnx_session = self._export_onnx_session(eager_model, shape)
+            session = self._onnx_session
+            import numpy as np
+
+            device = torch.device(self.device)
+            device_id = device.index or 0
+            vocab_size = session.get_outputs()[0].shape[-1]  # Static; only batch/seq_len are dynamic
+
+            def engine(input_ids, attention_mask):
+                # Bind torch buffers directly so inputs and logits stay on the device
+                binding = session.io_binding()
+                # Binding only records raw pointers, so converted inputs must outlive the run
+                bound = {
+                    "input_ids": input_ids.to(torch.long).contiguous(),
+                    "attention_mask": attention_mask.to(torch.long).contiguous(),
+                }
+                for name, tensor in bound.items():
+                    binding.bind_input(
+                        name=name, device_type=device.type, device_id=device_id,
+                        element_type=np.int64, shape=tuple(tensor.shape), buffer_ptr=tensor.data_ptr(),
+                    )
+                logits = torch.empty(
+                    (*input_ids.shape, vocab_size), dtype=torch.float32, device=device
+                )
+                binding.bind_output(
+                    name="logits", device_type=device.type, device_id=device_id,
+                    element_type=np.float32, shape=tuple(logits.shape), buffer_ptr=logits.data_ptr(),
+                )
+                session.run_with_iobinding(binding)
+                return logits
+
+            return engine
+
+        raise ValueError(f"Unknown compile_backend: {self.compile_backend}")
+
+    def _export_onnx_session(self, eager_model, shape: Tuple[int, int]):
+        """
+        Export the model to ONNX (unless onnx_path already exists) and open an ONNX Runtime session.
+
+        The export uses dynamic batch/sequence axes, so one session serves every
+        input shape. ONNX Runtime has few bf16 kernels, so a float32 copy of the
+        model is built on the CPU and exported; the served model (which may be
+        shared through model=) is left untouched. On CUDA the session runs on
+        torch's current stream, so device-bound inputs and outputs need no
+        extra synchronization.
+
+        Args:
+            eager_model: The eager (uncompiled) model
+            shape: (batch, seq_len) of the dummy input used for tracing
+
+        Returns:
+            session: onnxruntime.InferenceSession producing "logits"
+        """
+        import onnxruntime
+
+        on_cuda = torch.device(self.device).type == "cuda"
+        onnx_path = self.onnx_path
+
+        if not os.path.exists(onnx_path):
+            export_model = AutoModelForMaskedLM.from_config(
+                eager_model.config, trust_remote_code=True, torch_dtype=torch.float32
+            )
+            export_model.load_state_dict({
+                name: tensor.to("cpu", torch.float32) if tensor.is_floating_point() else tensor.cpu()
+                for name, tensor in eager_model.state_dict().items()
+            })
+            export_model.eval()
+
+            input_ids = torch.full(shape, self.mask_token_id, dtype=torch.long)
+            torch.onnx.export(
+                _LogitsForward(export_model),
+                (input_ids, torch.ones_like(input_ids)),
+                onnx_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={
+                    name: {0: "batch", 1: "seq_len"}
+                    for name in ("input_ids", "attention_mask", "logits")
+                },
+                opset_version=17,
+            )
+            del export_model
+
+        if on_cuda:
+            cuda_options = {
+                "device_id": torch.device(self.device).index or 0,
+                "user_compute_stream": str(torch.cuda.current_stream().cuda_stream),
+            }
+            providers = [("CUDAExecutionProvider", cuda_options), "CPUExecutionProvider"]
+        else:
+            providers = ["CPUExecutionProvider"]
+        return onnxruntime.InferenceSession(onnx_path, providers=providers)
+
+    def warmup(self, seq_len: int) -> None:
+        """
+        Run dummy forwards at a given length so compilation happens before real calls.
+
+        With compile_backend set, this is where the engine for the shape is
+        built (lazily, once the first input length is known); on failure the
+        mutator keeps running the eager model.
 
-        self.model.eval()
+        Args:
+            seq_len: Token length of the inputs that will follow
+        """
+        shape = (1, seq_len)
+        if self.compile_backend is not None and shape not in self._static_engines:
+            try:
+                self._static_engines[shape] = self._build_static_engine(shape)
+            except Exception as e:
+                print(f"Warning: {self.compile_backend} compilation failed ({e}); using eager model")
+                self.compile_backend = None
+            return
+
+        if getattr(self.model, "_orig_mod", None) is None or seq_len in self._warm_shapes:
+            return
+        input_ids = torch.full(
+            (1, seq_len), self.mask_token_id, dtype=torch.long, device=self.device
+        )
+        attention_mask = torch.ones_like(input_ids)
+        with torch.inference_mode():
+            for _ in range(2):
+                self._forward(input_ids, attention_mask)
+        self._warm_shapes.add(seq_len)
 
     @staticmethod
     def _load_weights_safetensors(model, safetensors_path):
@@ -122,6 +501,21 @@ class UncertaintyGuidedMutation:
         model.load_state_dict(loaded_state_dict)
         return model
 
+    def set_sequence(self, temp_pept_seq: str) -> None:
+        """
+        Replace the peptide sequence to mutate, keeping the loaded model.
+
+        Lets one mutator be reused across rounds (e.g. iterative refinement)
+        instead of reloading the model for every new sequence.
+
+        Args:
+            temp_pept_seq: New peptide sequence to mutate
+        """
+        if not temp_pept_seq:
+            raise ValueError("temp_pept_seq must be a non-empty sequence.")
+        self.temp_pept_seq = temp_pept_seq
+        self.use_template = False
+
     def get_template_sequence(self) -> str:
         """
         Get the template sequence for the specified modality.
@@ -163,7 +557,7 @@ class UncertaintyGuidedMutation:
 
         return self.temp_pept_seq
 
-    def get_nanobody_cdr_residues(self) -> List[int]:
+    def get_nanobody_cdr_residues(self, peptide_seq: str | None = None) -> List[int]:
         """
         Get residue indices for specified CDR regions in nanobody.
 
@@ -173,6 +567,9 @@ class UncertaintyGuidedMutation:
         Only works for nanobody modality. Returns residue indices (0-indexed)
         that correspond to the specified CDR regions.
 
+        Args:
+            peptide_seq: Nanobody sequence to number (default: get_peptide_sequence())
+
         Returns:
             cdr_residues: List of residue indices (0-indexed) in the CDR regions
 
@@ -191,7 +588,8 @@ class UncertaintyGuidedMutation:
             )
 
         # Get the peptide sequence
-        peptide_seq = self.get_peptide_sequence()
+        if peptide_seq is None:
+            peptide_seq = self.get_peptide_sequence()
 
         # Use abnumber if available for accurate CDR identification
         if HAS_ABNUMBER:
@@ -200,6 +598,39 @@ class UncertaintyGuidedMutation:
             # Fallback to hardcoded positions
             return self._get_cdr_residues_fallback()
 
+    @staticmethod
+    def _cdr_indices_abnumber(nanobody_seq: str) -> Dict[str, torch.Tensor]:
+        """
+        Get per-residue CDR indices from abnumber's IMGT-numbered positions.
+
+        Walks the numbered positions in order instead of searching for each
+        CDR string, so repeated CDR motifs cannot be matched at the wrong place.
+
+        Args:
+            nanobody_seq: Nanobody sequence
+
+        Returns:
+            cdr_indices: {"CDR1": LongTensor, "CDR2": LongTensor, "CDR3": LongTensor}
+                of residue indices (0-indexed) in nanobody_seq
+        """
+        chain = Chain(nanobody_seq, scheme='imgt')
+
+        # The numbered domain may not start at the first residue of the input
+        offset = nanobody_seq.find(chain.seq)
+        if offset == -1:
+            raise ValueError("Numbered domain not found in nanobody sequence")
+
+        cdr_indices = {"CDR1": [], "CDR2": [], "CDR3": []}
+        for i, pos in enumerate(chain.positions):
+            region = pos.get_region()
+            if region in cdr_indices:
+                cdr_indices[region].append(offset + i)
+
+        return {
+            cdr_name: torch.tensor(indices, dtype=torch.long)
+            for cdr_name, indices in cdr_indices.items()
+        }
+
     def _get_cdr_residues_abnumber(self, nanobody_seq: str) -> List[int]:
         """
         Get CDR residues using abnumber library with IMGT numbering.
@@ -211,32 +642,19 @@ class UncertaintyGuidedMutation:
             cdr_residues: List of residue indices (0-indexed)
         """
         try:
-            chain = Chain(nanobody_seq, scheme='imgt')
+            cdr_indices = self._cdr_indices_abnumber(nanobody_seq)
 
-            # Map CDR names to abnumber attributes
-            cdr_map = {
-                "CDR1": chain.cdr1_seq,
-                "CDR2": chain.cdr2_seq,
-                "CDR3": chain.cdr3_seq,
-            }
-
-            cdr_residues = []
             for cdr_name in self.nanobody_cdr_regions:
-                if cdr_name not in cdr_map:
+                if cdr_name not in cdr_indices:
                     raise ValueError(
                         f"Unknown CDR region: {cdr_name}. "
-                        f"Choose from {list(cdr_map.keys())}"
+                        f"Choose from {list(cdr_indices.keys())}"
                     )
 
-                cdr_seq = cdr_map[cdr_name]
-                if cdr_seq:
-                    # Find the CDR sequence in the full sequence
-                    start_idx = nanobody_seq.find(cdr_seq)
-                    if start_idx != -1:
-                        end_idx = start_idx + len(cdr_seq) - 1
-                        cdr_residues.extend(range(start_idx, end_idx + 1))
-
-            return sorted(list(set(cdr_residues)))  # Remove duplicates and sort
+            cdr_residues = torch.cat(
+                [cdr_indices[cdr_name] for cdr_name in self.nanobody_cdr_regions]
+            )
+            return torch.unique(cdr_residues, sorted=True).tolist()  # Remove duplicates and sort
 
         except Exception as e:
             print(f"Warning: abnumber CDR identification failed: {e}")
@@ -250,19 +668,17 @@ class UncertaintyGuidedMutation:
         Returns:
             cdr_residues: List of residue indices (0-indexed)
         """
-        cdr_defs = NANOBODY_CDR_REGIONS_IMGT
-
-        cdr_residues = []
         for cdr_name in self.nanobody_cdr_regions:
-            if cdr_name not in cdr_defs:
+            if cdr_name not in NANOBODY_CDR_IDX_TENSOR:
                 raise ValueError(
                     f"Unknown CDR region: {cdr_name}. "
-                    f"Choose from {list(cdr_defs.keys())}"
+                    f"Choose from {list(NANOBODY_CDR_IDX_TENSOR.keys())}"
                 )
-            start, end = cdr_defs[cdr_name]
-            cdr_residues.extend(range(start, end + 1))
 
-        return sorted(list(set(cdr_residues)))  # Remove duplicates and sort
+        cdr_residues = torch.cat(
+            [NANOBODY_CDR_IDX_TENSOR[cdr_name] for cdr_name in self.nanobody_cdr_regions]
+        )
+        return torch.unique(cdr_residues, sorted=True).tolist()  # Remove duplicates and sort
 
     def identify_nanobody_cdrs(self, nanobody_seq: str) -> Dict[str, Tuple[int, int, str]]:
         """
@@ -298,21 +714,14 @@ class UncertaintyGuidedMutation:
             cdr_dict: Dictionary with CDR info
         """
         try:
-            chain = Chain(nanobody_seq, scheme='imgt')
+            cdr_indices = self._cdr_indices_abnumber(nanobody_seq)
 
             cdr_dict = {}
-            cdr_map = {
-                "CDR1": chain.cdr1_seq,
-                "CDR2": chain.cdr2_seq,
-                "CDR3": chain.cdr3_seq,
-            }
-
-            for cdr_name, cdr_seq in cdr_map.items():
-                if cdr_seq:
-                    start_idx = nanobody_seq.find(cdr_seq)
-                    if start_idx != -1:
-                        end_idx = start_idx + len(cdr_seq) - 1
-                        cdr_dict[cdr_name] = (start_idx, end_idx, cdr_seq)
+            for cdr_name, indices in cdr_indices.items():
+                if indices.numel() > 0:
+                    start_idx = int(indices[0])
+                    end_idx = int(indices[-1])
+                    cdr_dict[cdr_name] = (start_idx, end_idx, nanobody_seq[start_idx:end_idx + 1])
 
             return cdr_dict
 
@@ -365,40 +774,102 @@ class UncertaintyGuidedMutation:
         # In reality, tokenization may vary
         token_indices = [peptide_start_idx + idx for idx in residue_indices]
         return token_indices
+
+    @staticmethod
+    def _check_token_positions(positions: List[int], seq_len: int) -> None:
+        """
+        Reject token positions outside the unpadded input.
+
+        Inputs are padded, so a residue index past the end of the peptide
+        would otherwise land on a padding slot and be silently generated.
+
+        Args:
+            positions: Token positions to mask
+            seq_len: Unpadded token length of the input
+
+        Raises:
+            ValueError: If any position is outside [0, seq_len)
+        """
+        out_of_range = [pos for pos in positions if not 0 <= pos < seq_len]
+        if out_of_range:
+            raise ValueError(
+                f"Token positions {out_of_range} are outside the input sequence (length {seq_len}); "
+                "check residues_to_mutate / CDR indices against the peptide length."
+            )
     
-    def get_logprobs(self, seq: str) -> Tuple[torch.Tensor, torch.Tensor, List[int]]:
+    def get_logprobs(
+        self,
+        inputs: Dict[str, torch.Tensor],
+        return_entropy: bool = False
+    ) -> Tuple[torch.Tensor, ...]:
         """
         Get log probabilities for each position in sequence.
         
         Args:
-            seq: Input sequence (no masks)
+            inputs: Tokenizer output (return_tensors='pt') for the input sequence (no masks)
+            return_entropy: Also return the predictive entropy of each position
             
         Returns:
             logprobs: Log probabilities for each position (seq_len,)
             probs: Probabilities for each position (seq_len,)
-            mask_indices: Indices of non-special tokens
+            mask_indices: Indices of non-special tokens (LongTensor on self.device)
+            entropy: Entropy of each position's distribution (seq_len,), only if return_entropy
         """
-        inputs = self.tokenizer(seq, return_tensors='pt')
-        input_ids = inputs['input_ids'].to(self.device)
-        attention_mask = inputs['attention_mask'].to(self.device)
+        input_ids = self._to_device(inputs['input_ids'])
+        attention_mask = self._to_device(inputs['attention_mask'])
         
         with torch.inference_mode():
-            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
-            logits = outputs.logits[0]  # (seq_len, vocab_size)
-        
-        # Get probabilities
-        probs = torch.softmax(logits, dim=-1)  # (seq_len, vocab_size)
-        
-        # Get max probability for each position (greedy prediction)
-        max_probs, _ = torch.max(probs, dim=-1)  # (seq_len,)
-        logprobs = torch.log(max_probs + 1e-10)  # Add small epsilon to avoid log(0)
+            logits = self._forward(input_ids, attention_mask).logits[0]  # (seq_len, vocab_size)
+
+            # Get max log probability for each position (greedy prediction)
+            if return_entropy:
+                entropy, logprobs = self._entropy_and_max_logprob(logits)
+            else:
+                logprobs = self._max_logprob(logits)  # (seq_len,)
+        del logits  # Only the per-position maxima are used downstream
+        max_probs = logprobs.exp()  # (seq_len,)
         
-        # Get non-special token indices
-        mask_token_id = self.tokenizer.mask_token_id
-        non_special_mask = input_ids[0] != mask_token_id
-        mask_indices = torch.where(non_special_mask)[0].tolist()
+        # Get non-special token indices (special tokens and padding excluded); same as
+        # tokenizer.get_special_tokens_mask(already_has_special_tokens=True), on device
+        non_special_mask = ~torch.isin(input_ids[0], self.special_ids_device) & attention_mask[0].bool()
+        mask_indices = torch.where(non_special_mask)[0]
         
+        if return_entropy:
+            return logprobs, max_probs, mask_indices, entropy
         return logprobs, max_probs, mask_indices
+
+    @staticmethod
+    def _max_logprob(logits: torch.Tensor) -> torch.Tensor:
+        """
+        Max log probability of each position, without a full softmax.
+
+        log p_max = max(logits) - logsumexp(logits), so only per-position
+        reductions are kept and no normalized distribution is materialized.
+
+        Args:
+            logits: Model logits (..., vocab_size)
+
+        Returns:
+            max_logprobs: Max log probability in fp32 (...)
+        """
+        max_logits = logits.amax(dim=-1)
+        return max_logits.float() - torch.logsumexp(logits.float(), dim=-1)
+
+    @staticmethod
+    def _entropy_and_max_logprob(logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Entropy and max log probability of each position from one log_softmax.
+
+        Args:
+            logits: Model logits (..., vocab_size)
+
+        Returns:
+            entropy: -sum(p * log p) over the vocabulary (...)
+            max_logprobs: Max log probability (...)
+        """
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        entropy = -(log_probs.exp() * log_probs).sum(dim=-1)
+        return entropy, log_probs.amax(dim=-1)
     
     def compute_uncertainty(self, probs: torch.Tensor) -> torch.Tensor:
         """
@@ -417,8 +888,9 @@ class UncertaintyGuidedMutation:
     def select_positions_to_mask(
         self,
         uncertainty: torch.Tensor,
-        mask_indices: List[int],
-        peptide_start_idx: int | None = None
+        mask_indices: torch.Tensor,
+        peptide_start_idx: int | None = None,
+        entropy: torch.Tensor | None = None
     ) -> List[int]:
         """
         Select positions to mask based on uncertainty, CDR regions, or custom residue indices.
@@ -426,8 +898,9 @@ class UncertaintyGuidedMutation:
 
         Args:
             uncertainty: Uncertainty scores for each position
-            mask_indices: Indices of non-special tokens
+            mask_indices: Indices of non-special tokens (LongTensor, same device as uncertainty)
             peptide_start_idx: Token index where peptide sequence starts (after <eos>)
+            entropy: Per-position entropy from get_logprobs (required for the entropy strategy)
 
         Returns:
             positions_to_mask: List of token positions to mask
@@ -451,129 +924,156 @@ class UncertaintyGuidedMutation:
             )
             return positions_to_mask
 
-        # Filter mask_indices to only include peptide positions
+        # Filter mask_indices to only include peptide positions (stays on device)
         if peptide_start_idx is not None:
-            peptide_mask_indices = [idx for idx in mask_indices if idx >= peptide_start_idx]
+            peptide_mask_indices = mask_indices[mask_indices >= peptide_start_idx]
         else:
             peptide_mask_indices = mask_indices
 
-        if not peptide_mask_indices:
+        n_peptide = peptide_mask_indices.numel()
+        if n_peptide == 0:
             return []
 
+        peptide_uncertainty = uncertainty[peptide_mask_indices]
+
         if self.mask_strategy == "top_k":
             # Mask top-k most uncertain positions in peptide
-            n_mask = max(1, int(len(peptide_mask_indices) * self.mask_ratio))
-            _, top_uncertain_indices = torch.topk(
-                uncertainty[peptide_mask_indices], k=min(n_mask, len(peptide_mask_indices))
-            )
-            positions_to_mask = [peptide_mask_indices[i] for i in top_uncertain_indices.tolist()]
+            n_mask = max(1, int(n_peptide * self.mask_ratio))
+            _, top_uncertain_indices = torch.topk(peptide_uncertainty, k=min(n_mask, n_peptide))
+            positions_to_mask = peptide_mask_indices[top_uncertain_indices]
 
         elif self.mask_strategy == "threshold":
             # Mask positions above uncertainty threshold in peptide
-            positions_to_mask = [
-                idx for idx in peptide_mask_indices
-                if uncertainty[idx] > self.uncertainty_threshold
-            ]
+            positions_to_mask = peptide_mask_indices[peptide_uncertainty > self.uncertainty_threshold]
 
         elif self.mask_strategy == "entropy":
-            # Use entropy-based uncertainty (requires full probability distribution)
-            positions_to_mask = [peptide_mask_indices[0]]  # Placeholder
+            # Mask the highest-entropy positions in peptide, same budget as top_k
+            if entropy is None:
+                raise ValueError("entropy required when mask_strategy='entropy'")
+            n_mask = max(1, int(n_peptide * self.mask_ratio))
+            _, top_entropy_indices = torch.topk(entropy[peptide_mask_indices], k=min(n_mask, n_peptide))
+            positions_to_mask = peptide_mask_indices[top_entropy_indices]
 
         else:
             raise ValueError(f"Unknown mask_strategy: {self.mask_strategy}")
 
-        return positions_to_mask
+        # Single device-to-host transfer, at the boundary where ints are needed
+        return positions_to_mask.tolist()
     
     def create_masked_sequence(
         self, 
-        seq: str, 
+        inputs: Dict[str, torch.Tensor], 
         positions_to_mask: List[int]
-    ) -> str:
+    ) -> torch.Tensor:
         """
-        Create masked sequence by replacing positions with [MASK].
+        Create masked input ids by replacing positions with [MASK].
+
+        Works on token ids directly, so no decode/re-tokenize round trip is needed.
         
         Args:
-            seq: Original sequence
+            inputs: Tokenizer output (return_tensors='pt') for the original sequence
             positions_to_mask: Token positions to mask
             
         Returns:
-            masked_seq: Sequence with [MASK] tokens
+            masked_input_ids: Input ids with [MASK] tokens (1, seq_len), on self.device
+
+        Raises:
+            ValueError: If a position is outside the unpadded input
         """
-        inputs = self.tokenizer(seq, return_tensors='pt')
-        input_ids = inputs['input_ids'][0].tolist()
-        
-        # Replace positions with mask token
-        mask_token_id = self.tokenizer.mask_token_id
-        for pos in positions_to_mask:
-            input_ids[pos] = mask_token_id
-        
-        # Decode back to sequence
-        masked_seq = self.tokenizer.decode(input_ids, skip_special_tokens=False)
-        return masked_seq
+        self._check_token_positions(positions_to_mask, int(inputs['attention_mask'][0].sum()))
+        positions = torch.as_tensor(positions_to_mask, dtype=torch.long, device=self.device)
+        return self._to_device(inputs['input_ids']).clone().index_fill_(1, positions, self.mask_token_id)
     
-    def generate_mutations(self, masked_seq: str) -> List[str]:
+    def generate_mutations(
+        self,
+        masked_input_ids: torch.Tensor,
+        attention_mask: torch.Tensor
+    ) -> List[str]:
         """
-        Generate mutated sequences from masked sequence.
+        Generate mutated sequences from masked input ids.
         
         Args:
-            masked_seq: Sequence with [MASK] tokens
+            masked_input_ids: Input ids with [MASK] tokens (1, seq_len)
+            attention_mask: Attention mask (1, seq_len)
             
         Returns:
             generated_sequences: List of generated sequences
         """
-        inputs = self.tokenizer(masked_seq, return_tensors='pt')
-        input_ids = inputs['input_ids'].to(self.device)
-        attention_mask = inputs['attention_mask'].to(self.device)
-        
-        # Identify mask token positions
-        mask_token_id = self.tokenizer.mask_token_id
-        mask_indices = (input_ids == mask_token_id).nonzero(as_tuple=False)
+        return self._generate_mutations_batch(masked_input_ids, attention_mask)[0]
+
+    def _generate_mutations_batch(
+        self,
+        masked_input_ids: torch.Tensor,
+        attention_mask: torch.Tensor
+    ) -> List[List[str]]:
+        """
+        Generate n_seq_out mutated sequences for every row of a masked batch.
+
+        Args:
+            masked_input_ids: Input ids with [MASK] tokens (batch, seq_len)
+            attention_mask: Attention mask (batch, seq_len)
+
+        Returns:
+            generated_sequences: One list of generated sequences per row
+        """
+        input_ids = self._to_device(masked_input_ids)
+        attention_mask = self._to_device(attention_mask)
+        batch_size, seq_len = input_ids.shape
         
-        generated_sequences = []
+        # Identify mask token positions as (row, position) pairs
+        mask_indices = (input_ids == self.mask_token_id).nonzero(as_tuple=False)
         
         with torch.inference_mode():
-            for _ in tqdm(range(self.n_seq_out), desc="Generating mutations"):
-                outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
-                logits = outputs.logits[0]
-                
-                sampled_ids = input_ids.clone()
-                
-                for idx in mask_indices:
-                    pos = idx[1]
-                    probs = torch.softmax(logits[pos], dim=-1)
-                    sampled_token_id = torch.multinomial(probs, num_samples=1)
-                    sampled_ids[0, pos] = sampled_token_id
-                
-                decoded_seq = self.tokenizer.decode(sampled_ids[0], skip_special_tokens=True)
-                seq_out = "".join(decoded_seq.split())
-                generated_sequences.append(seq_out)
-        
-        return generated_sequences
+            sampled_ids = input_ids.repeat(self.n_seq_out, 1, 1)  # (n_seq_out, batch, seq_len)
+
+            if mask_indices.numel() > 0:
+                # Logits are deterministic for a fixed masked input: run the model
+                # once and draw all n_seq_out samples from the same distribution
+                outputs = self._forward(input_ids, attention_mask)
+                logits = outputs.logits  # (batch, seq_len, vocab_size)
+
+                mask_rows, mask_positions = mask_indices[:, 0], mask_indices[:, 1]
+                # Embeddings may be padded past the tokenizer vocab; only sample ids id2tok can map
+                mask_logits = logits[mask_rows, mask_positions, :len(self.id2tok)]  # (n_masks, vocab_size)
+                # Softmax in the model dtype (bf16); multinomial needs fp32 input
+                probs = torch.softmax(mask_logits, dim=-1)
+                sampled = torch.multinomial(
+                    probs.float(), num_samples=self.n_seq_out, replacement=True
+                )  # (n_masks, n_seq_out)
+
+                sampled_ids[:, mask_rows, mask_positions] = sampled.T
+
+        # One host copy, then join residue tokens directly (no decode + whitespace strip)
+        sampled_rows = sampled_ids.transpose(0, 1).reshape(-1, seq_len).tolist()
+        generated_sequences = [
+            "".join(self.id2tok[i] for i in ids if i not in self.special_ids)
+            for ids in sampled_rows
+        ]
+
+        return [
+            generated_sequences[row * self.n_seq_out:(row + 1) * self.n_seq_out]
+            for row in range(batch_size)
+        ]
     
-    def find_peptide_start_idx(self, input_seq: str) -> int:
+    def find_peptide_start_idx(self, inputs: Dict[str, torch.Tensor]) -> int:
         """
         Find the token index where the peptide sequence starts (after <eos>).
 
         Args:
-            input_seq: Full input sequence with target<eos>peptide
+            inputs: Tokenizer output (return_tensors='pt') for target<eos>peptide
 
         Returns:
             peptide_start_idx: Token index where peptide starts
         """
-        # Tokenize to find where <eos> token is
-        inputs = self.tokenizer(input_seq, return_tensors='pt')
-        input_ids = inputs['input_ids'][0].tolist()
-
-        # Find <eos> token ID
-        eos_token_id = self.tokenizer.eos_token_id
+        input_ids = inputs['input_ids'][0]
 
-        # Find the position of <eos> token
-        try:
-            eos_idx = input_ids.index(eos_token_id)
-            peptide_start_idx = eos_idx + 1  # Position right after <eos>
-        except ValueError:
-            # If <eos> not found, assume peptide starts at middle
-            peptide_start_idx = len(input_ids) // 2
+        # Find the position of the first <eos> token without building a Python list
+        eos_positions = (input_ids == self.eos_token_id).nonzero(as_tuple=True)[0]
+        if eos_positions.numel() > 0:
+            peptide_start_idx = int(eos_positions[0]) + 1  # Position right after <eos>
+        else:
+            # If <eos> not found, assume peptide starts at middle (of the unpadded tokens)
+            peptide_start_idx = int(inputs['attention_mask'][0].sum()) // 2
             print(f"Warning: <eos> token not found. Assuming peptide starts at index {peptide_start_idx}")
 
         return peptide_start_idx
@@ -591,40 +1091,58 @@ class UncertaintyGuidedMutation:
 
         # Step 1: Create input sequence
         input_seq = f"{self.target_seq}<eos>{peptide_seq}"
-        print(f"Modality: {self.modality}")
-        print(f"Input sequence: {input_seq}")
 
-        # Step 2: Get logprobs and uncertainty
-        _, probs, mask_indices = self.get_logprobs(input_seq)
-        uncertainty = self.compute_uncertainty(probs)
+        # Tokenize once and share the result across the pipeline stages
+        inputs = self._tokenize(input_seq)
+        seq_len = int(inputs['attention_mask'].sum())  # Unpadded token length
+
+        # Compile for this input length before the first real forward
+        self.warmup(inputs['input_ids'].shape[1])
 
-        print(f"Uncertainty scores: {uncertainty[mask_indices]}")
+        # Step 2: Get logprobs and uncertainty (plus entropy when masking by it)
+        entropy = None
+        if self.mask_strategy == "entropy":
+            _, probs, mask_indices, entropy = self.get_logprobs(inputs, return_entropy=True)
+        else:
+            _, probs, mask_indices = self.get_logprobs(inputs)
+        uncertainty = self.compute_uncertainty(probs)
 
         # Step 3: Find where peptide starts
-        peptide_start_idx = self.find_peptide_start_idx(input_seq)
-        print(f"Peptide starts at token index: {peptide_start_idx}")
+        peptide_start_idx = self.find_peptide_start_idx(inputs)
 
         # Step 4: Select positions to mask (only in peptide)
         positions_to_mask = self.select_positions_to_mask(
-            uncertainty, mask_indices, peptide_start_idx
+            uncertainty, mask_indices, peptide_start_idx, entropy
         )
-        print(f"Positions to mask (peptide only): {positions_to_mask}")
-
-        if self.residues_to_mutate is not None:
-            print(f"Custom residues to mutate: {self.residues_to_mutate}")
 
-        # Step 5: Create masked sequence
-        masked_seq = self.create_masked_sequence(input_seq, positions_to_mask)
-        print(f"Masked sequence: {masked_seq}")
+        # Step 5: Create masked input ids
+        masked_input_ids = self.create_masked_sequence(inputs, positions_to_mask)
 
         # Step 6: Generate mutations
-        generated_sequences = self.generate_mutations(masked_seq)
+        generated_sequences = self.generate_mutations(masked_input_ids, inputs['attention_mask'])
+
+        # Decode the masked input only for human-readable output
+        masked_seq = self.tokenizer.decode(masked_input_ids[0, :seq_len], skip_special_tokens=False)
+
+        # Progress output reads device tensors, so it is optional and only
+        # happens once generation has been issued
+        if self.verbose:
+            print(f"Modality: {self.modality}")
+            print(f"Input sequence: {input_seq}")
+            print(f"Uncertainty scores: {uncertainty[mask_indices]}")
+            print(f"Peptide starts at token index: {peptide_start_idx}")
+            print(f"Positions to mask (peptide only): {positions_to_mask}")
+            if self.residues_to_mutate is not None:
+                print(f"Custom residues to mutate: {self.residues_to_mutate}")
+            print(f"Masked sequence: {masked_seq}")
 
         return {
             "input_seq": input_seq,
             "peptide_seq": peptide_seq,
             "modality": self.modality,
-            "uncertainty": uncertainty,
+            "uncertainty": uncertainty[:seq_len],
+            "probs": probs[:seq_len],
+            "mask_indices": mask_indices,
             "peptide_start_idx": peptide_start_idx,
             "positions_to_mask": positions_to_mask,
             "masked_seq": masked_seq,
@@ -633,6 +1151,206 @@ class UncertaintyGuidedMutation:
         }
 
 
+    def select_positions_to_mask_batch(
+        self,
+        uncertainty: torch.Tensor,
+        token_mask: torch.Tensor,
+        peptide_start_idx: torch.Tensor,
+        peptide_seqs: List[str],
+        entropy: torch.Tensor | None = None,
+        seq_lens: List[int] | None = None
+    ) -> torch.Tensor:
+        """
+        Batched select_positions_to_mask over a padded (batch, seq_len) input.
+
+        Args:
+            uncertainty: Uncertainty scores (batch, seq_len)
+            token_mask: Candidate tokens (batch, seq_len), False on special tokens and padding
+            peptide_start_idx: Token index where each row's peptide starts (batch,)
+            peptide_seqs: Peptide sequence of each row (for CDR identification)
+            entropy: Per-position entropy (batch, seq_len), required for the entropy strategy
+            seq_lens: Unpadded token length of each row (default: the padded length)
+
+        Returns:
+            select: Boolean mask (batch, seq_len) of token positions to mask
+        """
+        batch_size, seq_len = uncertainty.shape
+        device = uncertainty.device
+        token_idx = torch.arange(seq_len, device=device)
+        peptide_start_idx = peptide_start_idx.to(device)
+
+        # Priority 1/2: CDR regions or custom residues, converted per row
+        if (self.nanobody_cdr_regions is not None and self.modality == "nanobody") \
+                or self.residues_to_mutate is not None:
+            select = torch.zeros((batch_size, seq_len), dtype=torch.bool, device=device)
+            for row, peptide_seq in enumerate(peptide_seqs):
+                if self.nanobody_cdr_regions is not None and self.modality == "nanobody":
+                    residues = self.get_nanobody_cdr_residues(peptide_seq)
+                else:
+                    residues = self.residues_to_mutate
+                positions = self.convert_residue_indices_to_token_indices(
+                    residues, int(peptide_start_idx[row])
+                )
+                self._check_token_positions(positions, seq_len if seq_lens is None else seq_lens[row])
+                select[row, torch.as_tensor(positions, dtype=torch.long, device=device)] = True
+            return select
+
+        # Only peptide (non-special, non-padding) positions are candidates
+        in_peptide = (token_idx >= peptide_start_idx[:, None]) & token_mask.to(device).bool()
+
+        if self.mask_strategy in ("top_k", "entropy"):
+            # Per-row k, then one topk over the batch with non-candidates at -inf
+            if self.mask_strategy == "entropy":
+                if entropy is None:
+                    raise ValueError("entropy required when mask_strategy='entropy'")
+                scores = entropy
+            else:
+                scores = uncertainty
+            # Same host arithmetic as select_positions_to_mask, so k matches run() exactly
+            n_mask = [
+                min(max(1, int(n_peptide * self.mask_ratio)), n_peptide)
+                for n_peptide in in_peptide.sum(dim=1).tolist()
+            ]
+            k_max = max(n_mask)
+            n_mask = torch.tensor(n_mask, device=device)
+            select = torch.zeros_like(in_peptide)
+            if k_max > 0:
+                scores = scores.float().masked_fill(~in_peptide, float("-inf"))
+                _, top_idx = torch.topk(scores, k=k_max, dim=1)
+                keep = torch.arange(k_max, device=device) < n_mask[:, None]
+                select.scatter_(1, top_idx, keep)
+
+        elif self.mask_strategy == "threshold":
+            select = in_peptide & (uncertainty > self.uncertainty_threshold)
+
+        else:
+            raise ValueError(f"Unknown mask_strategy: {self.mask_strategy}")
+
+        return select
+
+    def run_batch(
+        self,
+        peptide_seqs: List[str],
+        target_seqs: List[str] | None = None,
+        batch_size: int = 32
+    ) -> List[Dict[str, any]]:
+        """
+        Run the pipeline for many peptides with one padded forward per stage.
+
+        Inputs are sorted by length and split into micro-batches of similar
+        length, so little compute goes to padding; within a micro-batch,
+        uncertainty scoring and mutation generation each take one forward pass.
+        Masking follows the same settings as run().
+
+        Args:
+            peptide_seqs: Peptide sequences to mutate
+            target_seqs: Target sequence for each peptide (default: self.target_seq for all)
+            batch_size: Maximum number of sequences per forward pass
+
+        Returns:
+            results: One results dictionary per peptide (same keys as run()), in input order
+        """
+        if target_seqs is None:
+            target_seqs = [self.target_seq] * len(peptide_seqs)
+        if len(target_seqs) != len(peptide_seqs):
+            raise ValueError(
+                f"Got {len(target_seqs)} target sequences for {len(peptide_seqs)} peptides."
+            )
+
+        # Sort by combined length, run each micro-batch, then restore input order
+        order = sorted(
+            range(len(peptide_seqs)), key=lambda i: len(target_seqs[i]) + len(peptide_seqs[i])
+        )
+        results = [None] * len(peptide_seqs)
+        for start in range(0, len(order), batch_size):
+            chunk = order[start:start + batch_size]
+            chunk_results = self._run_padded_batch(
+                [peptide_seqs[i] for i in chunk], [target_seqs[i] for i in chunk]
+            )
+            for i, result in zip(chunk, chunk_results):
+                results[i] = result
+
+        return results
+
+    def _run_padded_batch(
+        self,
+        peptide_seqs: List[str],
+        target_seqs: List[str]
+    ) -> List[Dict[str, any]]:
+        """
+        Run the pipeline on one padded batch of (target, peptide) pairs.
+
+        Args:
+            peptide_seqs: Peptide sequences to mutate
+            target_seqs: Target sequence for each peptide
+
+        Returns:
+            results: One results dictionary per peptide, in the given order
+        """
+        input_seqs = [f"{target}<eos>{peptide}" for target, peptide in zip(target_seqs, peptide_seqs)]
+        inputs = self._tokenize(input_seqs)
+        input_ids = self._to_device(inputs['input_ids'])
+        attention_mask = self._to_device(inputs['attention_mask'])
+
+        # Uncertainty for every row from a single forward pass
+        with torch.inference_mode():
+            logits = self._forward(input_ids, attention_mask).logits  # (batch, seq_len, vocab_size)
+            entropy = None
+            if self.mask_strategy == "entropy":
+                entropy, max_logprobs = self._entropy_and_max_logprob(logits)
+            else:
+                max_logprobs = self._max_logprob(logits)  # (batch, seq_len)
+        del logits
+        probs = max_logprobs.exp()  # (batch, seq_len)
+        uncertainty = self.compute_uncertainty(probs)
+
+        token_mask = attention_mask.bool() & ~torch.isin(input_ids, self.special_ids_device)
+
+        # Peptide starts right after the first <eos> of each row; rows without
+        # <eos> fall back to the middle of the unpadded sequence, as in run()
+        is_eos = inputs['input_ids'] == self.eos_token_id
+        has_eos = is_eos.any(dim=1)
+        seq_lens = inputs['attention_mask'].sum(dim=1)
+        peptide_start_idx = torch.where(has_eos, is_eos.int().argmax(dim=1) + 1, seq_lens // 2)
+        for row in (~has_eos).nonzero(as_tuple=True)[0].tolist():
+            print(
+                f"Warning: <eos> token not found in row {row}. "
+                f"Assuming peptide starts at index {int(peptide_start_idx[row])}"
+            )
+
+        seq_lens = seq_lens.tolist()
+        select = self.select_positions_to_mask_batch(
+            uncertainty, token_mask, peptide_start_idx, peptide_seqs, entropy, seq_lens
+        )
+        masked_input_ids = input_ids.masked_fill(select, self.mask_token_id)
+
+        generated_sequences = self._generate_mutations_batch(masked_input_ids, attention_mask)
+
+        # Rows are right-padded (padding_side set in __post_init__); trim before decoding
+        masked_seqs = self.tokenizer.batch_decode(
+            [ids[:seq_len] for ids, seq_len in zip(masked_input_ids.tolist(), seq_lens)],
+            skip_special_tokens=False,
+        )
+        select = select.cpu()
+
+        return [
+            {
+                "input_seq": input_seqs[row],
+                "peptide_seq": peptide_seqs[row],
+                "modality": self.modality,
+                "uncertainty": uncertainty[row, :seq_lens[row]],
+                "probs": probs[row, :seq_lens[row]],
+                "mask_indices": token_mask[row].nonzero(as_tuple=True)[0],
+                "peptide_start_idx": int(peptide_start_idx[row]),
+                "positions_to_mask": select[row].nonzero(as_tuple=True)[0].tolist(),
+                "masked_seq": masked_seqs[row],
+                "generated_sequences": generated_sequences[row],
+                "residues_to_mutate": self.residues_to_mutate,
+            }
+            for row in range(len(peptide_seqs))
+        ]
+
+
 if __name__ == "__main__":
     # Example usage
     target_seq = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQFEVV"